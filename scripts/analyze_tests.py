@@ -3,52 +3,136 @@
 Analyze wget test results and generate individual test failure documentation.
 """
 
+import argparse
+import io
 import json
+import os
+import re
 import sys
+import tarfile
+import time
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Top-level arrays holding test records, keyed by ijson prefix
+TEST_SECTIONS = {
+    'perl_tests.item': 'perl',
+    'python_tests.item': 'python',
+}
+
+# Test record fields used by this script; others are skipped while streaming
+TEST_FIELDS = frozenset((
+    'test_name', 'passed', 'failure_category', 'error_message', 'exit_code',
+    'description', 'execution_time', 'stdout', 'stderr',
+))
+
+# Failed tests queued before handing them to the worker pool; bounds how
+# many streamed records are held in memory at once
+WRITE_BATCH_SIZE = 1024
+
+# Characters of stdout/stderr kept from the start and end of each doc's
+# output blocks; the middle of longer output is elided
+OUTPUT_CLIP_HEAD = 4096
+OUTPUT_CLIP_TAIL = 4096
+
+# Characters in test names replaced by '_' to form doc file names
+SAFE_NAME_RE = re.compile(r'--|\.')
 
 def load_test_results(json_path):
-    """Load test results from JSON file."""
-    with open(json_path) as f:
-        return json.load(f)
+    """Load test results from JSON file (uses orjson when installed)."""
+    if orjson is None:
+        with open(json_path) as f:
+            return json.load(f)
+    with open(json_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+def iter_test_results(json_path, meta):
+    """Yield (test_type, test) for every test record in the results file.
+
+    Top-level scalar fields such as the timestamp are stored in `meta`.
+    With ijson installed the file is streamed so only one test record is
+    held in memory at a time, keeping just its TEST_FIELDS; otherwise it
+    is loaded in full.
+    """
+    if ijson is None:
+        data = load_test_results(json_path)
+        for key, value in data.items():
+            if not isinstance(value, (dict, list)):
+                meta[key] = value
+        for prefix, test_type in TEST_SECTIONS.items():
+            for test in data.get(prefix.split('.')[0], []):
+                yield test_type, test
+        return
+
+    with open(json_path, 'rb') as f:
+        section = None
+        builder = None
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if builder is not None:
+                if skipping:
+                    # Drop the whole value of an unlisted field, however nested
+                    if event in ('start_map', 'start_array'):
+                        skip_depth += 1
+                    elif event in ('end_map', 'end_array'):
+                        skip_depth -= 1
+                    skipping = skip_depth > 0
+                    continue
+                if depth == 1 and event == 'map_key' and value not in TEST_FIELDS:
+                    skipping = True
+                    skip_depth = 0
+                    continue
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                    if depth == 0:
+                        yield TEST_SECTIONS[section], builder.value
+                        builder = None
+            elif event == 'start_map' and prefix in TEST_SECTIONS:
+                section = prefix
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+                skipping = False
+            elif prefix and '.' not in prefix and event in ('string', 'number', 'boolean', 'null'):
+                meta[prefix] = value
 
 def categorize_failure(test):
     """Categorize the failure reason."""
-    category = test.get('failure_category', 'unknown')
-    if not category or category.strip() == '':
+    category = test.get('failure_category') or 'unknown'
+    if not category.strip():
         category = 'unknown'
-    error_msg = test.get('error_message', '')
-    stderr = test.get('stderr', '')
-
-    # Auto-categorize from error messages if category is unknown/empty
-    if category == 'unknown':
-        # Check stderr for patterns
-        if '--input-metalink' in error_msg or 'metalink' in stderr.lower():
-            return 'missing_feature_metalink'
-        if 'Not all files were crawled correctly' in stderr:
-            return 'test_framework_crawl_mismatch'
-        if 'do not match' in stderr or 'Contents of' in stderr and 'do not match' in stderr:
-            return 'test_framework_content_mismatch'
-        if 'Expected file' in stderr and 'not found' in stderr:
-            return 'test_framework_missing_file'
-        if 'No such file or directory' in stderr:
-            return 'test_framework_missing_file'
-        if test.get('exit_code') == 77:
-            return 'skipped_ssl_tls'
-        if 'unexpected argument' in stderr.lower():
-            return 'missing_cli_option'
-        if 'builder error' in stderr.lower() and 'ftp' in stderr.lower():
-            return 'missing_feature_ftp'
-        # Check for test pass but exit code mismatch
-        if 'Test Passed' in stderr or 'passed' in stderr.lower():
-            return 'exit_code_mismatch'
-
-    # More detailed categorization for known categories
-    if category == 'missing_feature':
-        if '--input-metalink' in error_msg or 'metalink' in stderr.lower():
-            return 'missing_feature_metalink'
-        return 'missing_feature_other'
+
+    if category == 'skipped':
+        return 'skipped_ssl_tls'
+
+    # 'timeout' and other explicit categories need no stderr inspection
+    if category not in ('unknown', 'missing_feature', 'test_framework_error'):
+        return category
+
+    # Metalink is the largest failure group (32 of the 66 failing Python
+    # tests in PYTHON_TEST_SUMMARY.txt). The '--input-metalink' check on
+    # error_message was already the first Metalink test and needs no
+    # stderr, so it runs before stderr is read; the stderr 'metalink'
+    # check below still catches the rest. The stderr checks stay
+    # first-match-wins in their original order.
+    if category != 'test_framework_error' and '--input-metalink' in (test.get('error_message') or ''):
+        return 'missing_feature_metalink'
+
+    stderr = test.get('stderr') or ''
 
     if category == 'test_framework_error':
         if 'Not all files were crawled correctly' in stderr:
@@ -59,60 +143,84 @@ def categorize_failure(test):
             return 'test_framework_missing_file'
         return 'test_framework_other'
 
-    if category == 'skipped':
-        return 'skipped_ssl_tls'
+    # Lowercased once for the checks that are case-insensitive
+    stderr_lower = stderr.lower()
 
-    if category == 'timeout':
-        return 'timeout'
+    if 'metalink' in stderr_lower:
+        return 'missing_feature_metalink'
+    if category == 'missing_feature':
+        return 'missing_feature_other'
 
+    # Auto-categorize unknown/empty categories from stderr patterns
+    if 'Not all files were crawled correctly' in stderr:
+        return 'test_framework_crawl_mismatch'
+    if 'do not match' in stderr:
+        return 'test_framework_content_mismatch'
+    if 'Expected file' in stderr and 'not found' in stderr:
+        return 'test_framework_missing_file'
+    if 'No such file or directory' in stderr:
+        return 'test_framework_missing_file'
+    if test.get('exit_code') == 77:
+        return 'skipped_ssl_tls'
+    if 'unexpected argument' in stderr_lower:
+        return 'missing_cli_option'
+    if 'builder error' in stderr_lower and 'ftp' in stderr_lower:
+        return 'missing_feature_ftp'
+    # Check for test pass but exit code mismatch
+    if 'passed' in stderr_lower:
+        return 'exit_code_mismatch'
     return category
 
-def generate_test_doc(test, test_type):
-    """Generate markdown documentation for a failed test."""
-    test_name = test['test_name']
-
-    # Sanitize test name for filename
-    safe_name = test_name.replace('--', '_').replace('.', '_')
-
-    doc = f"""# {test_name}
+DOC_HEADER_TMPL = """# {test_name}
 
 **Test Type**: {test_type}
 **Status**: ❌ FAILED
-**Category**: {test.get('failure_category', 'unknown')}
-**Execution Time**: {test.get('execution_time', 0):.2f}s
+**Category**: {failure_category}
+**Execution Time**: {execution_time:.2f}s
 
 ## Description
 
-{test.get('description', 'No description available')}
+{description}
 
 ## Error Details
 
-**Error Message**: {test.get('error_message', 'No error message')}
+**Error Message**: {error_message}
 
-**Exit Code**: {test.get('exit_code', 'unknown')}
+**Exit Code**: {exit_code}
 
 ## Test Output
 
 ### stdout
 ```
-{test.get('stdout', 'No stdout')}
+{stdout}
 ```
 
 ### stderr
 ```
-{test.get('stderr', 'No stderr')}
+{stderr}
 ```
 
 ## Analysis
 
 """
 
-    # Add automatic analysis based on error patterns
-    stderr = test.get('stderr', '')
-    error_msg = test.get('error_message', '')
+DOC_TRAILER = """
+## Implementation Notes
 
-    if 'Not all files were crawled correctly' in stderr:
-        doc += """
+_Add implementation notes here after investigation_
+
+## Related Tests
+
+_List related tests that might have similar issues_
+
+## References
+
+_Add links to relevant code sections or documentation_
+"""
+
+# Automatic analysis text, keyed by the category from categorize_failure()
+ANALYSIS_BY_CATEGORY = {
+    'test_framework_crawl_mismatch': """
 **Issue Type**: File crawling mismatch
 
 The test expects certain files to be downloaded/crawled, but wget-faster either:
@@ -130,9 +238,8 @@ The test expects certain files to be downloaded/crawled, but wget-faster either:
 1. Check which files were expected vs actual
 2. Review link extraction in recursive.rs
 3. Compare with GNU wget behavior
-"""
-    elif 'do not match' in stderr:
-        doc += """
+""",
+    'test_framework_content_mismatch': """
 **Issue Type**: Content mismatch
 
 The downloaded file content doesn't match expected content.
@@ -147,9 +254,8 @@ The downloaded file content doesn't match expected content.
 1. Compare actual vs expected file content
 2. Check HTTP response handling in downloader.rs
 3. Review content encoding/decoding
-"""
-    elif 'Expected file' in stderr and 'not found' in stderr:
-        doc += """
+""",
+    'test_framework_missing_file': """
 **Issue Type**: Missing file
 
 Expected file was not created or saved to wrong location.
@@ -164,9 +270,8 @@ Expected file was not created or saved to wrong location.
 1. Check file naming logic in recursive.rs
 2. Verify directory creation
 3. Check if download was attempted
-"""
-    elif '--input-metalink' in error_msg:
-        doc += """
+""",
+    'missing_feature_metalink': """
 **Issue Type**: Missing feature - Metalink
 
 Metalink support is not implemented in wget-faster.
@@ -176,9 +281,8 @@ Metalink support is not implemented in wget-faster.
 **Impact**: 32 tests (19% of all tests)
 
 **Priority**: Low - not critical for current goals
-"""
-    elif test.get('failure_category') == 'skipped':
-        doc += """
+""",
+    'skipped_ssl_tls': """
 **Issue Type**: Feature not available (skipped)
 
 Test requires SSL/TLS features that are not configured.
@@ -192,9 +296,8 @@ Test requires SSL/TLS features that are not configured.
 **Status**: Deferred to v0.2.0+
 
 **Priority**: Medium - needed for advanced HTTPS
-"""
-    elif test.get('failure_category') == 'timeout':
-        doc += """
+""",
+    'timeout': """
 **Issue Type**: Test timeout
 
 Test exceeded maximum execution time (usually 60s).
@@ -211,103 +314,174 @@ Test exceeded maximum execution time (usually 60s).
 1. Run test manually with debug output
 2. Check for infinite loops
 3. Review auth handling
-"""
-
-    doc += """
-## Implementation Notes
-
-_Add implementation notes here after investigation_
+""",
+}
 
-## Related Tests
+def clip_output(text, head=OUTPUT_CLIP_HEAD, tail=OUTPUT_CLIP_TAIL):
+    """Shorten long test output to its first `head` and last `tail` characters."""
+    if not isinstance(text, str) or len(text) <= head + tail:
+        return text
+    return f"{text[:head]}\n... [{len(text) - head - tail} characters elided] ...\n{text[-tail:]}"
 
-_List related tests that might have similar issues_
+def generate_test_doc(test, test_type, category):
+    """Generate markdown documentation for a failed test.
 
-## References
-
-_Add links to relevant code sections or documentation_
-"""
+    `category` is the result of categorize_failure() and selects the
+    analysis section.
+    """
+    test_name = test['test_name']
 
-    return doc
+    header = DOC_HEADER_TMPL.format_map({
+        'test_name': test_name,
+        'test_type': test_type,
+        'failure_category': test.get('failure_category', 'unknown'),
+        'execution_time': test.get('execution_time', 0),
+        'description': test.get('description', 'No description available'),
+        'error_message': test.get('error_message', 'No error message'),
+        'exit_code': test.get('exit_code', 'unknown'),
+        'stdout': clip_output(test.get('stdout', 'No stdout')),
+        'stderr': clip_output(test.get('stderr', 'No stderr')),
+    })
+
+    return "".join((header, ANALYSIS_BY_CATEGORY.get(category, ''), DOC_TRAILER))
+
+def write_test_doc(job):
+    """Generate and write the doc for one failed test (runs in a worker process)."""
+    test, test_type, category, doc_path = job
+    data = generate_test_doc(test, test_type, category).encode('utf-8')
+
+    # The doc is already built, so skip the buffered text layer of open()
+    fd = os.open(doc_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def render_test_doc(job):
+    """Generate the doc for one failed test as (file name, UTF-8 bytes) (runs in a worker process)."""
+    test, test_type, category, doc_path = job
+    return Path(doc_path).name, generate_test_doc(test, test_type, category).encode('utf-8')
+
+@contextmanager
+def open_archive(archive_path):
+    """Open a tar file for writing that replaces `archive_path` only once complete."""
+    tmp_path = archive_path.with_name(archive_path.name + '.tmp')
+    try:
+        with tarfile.open(tmp_path, 'w') as archive:
+            yield archive
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, archive_path)
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: analyze_tests.py <test_results.json>")
-        sys.exit(1)
-
-    json_path = Path(sys.argv[1])
+    parser = argparse.ArgumentParser(
+        description='Generate per-test failure documentation in todo/.')
+    parser.add_argument('json_path', type=Path, help='test_results.json from wget-faster-test')
+    parser.add_argument('--archive', action='store_true',
+                        help='write the per-test docs into todo/reports.tar instead of individual files')
+    args = parser.parse_args()
+
+    json_path = args.json_path
     if not json_path.exists():
         print(f"Error: {json_path} not found")
         sys.exit(1)
 
     print(f"Analyzing test results from {json_path}...")
 
-    data = load_test_results(json_path)
-
-    # Statistics
-    perl_tests = data.get('perl_tests', [])
-    python_tests = data.get('python_tests', [])
-
-    perl_failed = [t for t in perl_tests if not t['passed']]
-    python_failed = [t for t in python_tests if not t['passed']]
-
-    print(f"\nPerl tests: {len(perl_tests)} total, {len(perl_failed)} failed")
-    print(f"Python tests: {len(python_tests)} total, {len(python_failed)} failed")
-
-    # Categorize failures
-    categories = defaultdict(list)
-    for test in perl_failed:
-        cat = categorize_failure(test)
-        categories[cat].append(('perl', test))
-    for test in python_failed:
-        cat = categorize_failure(test)
-        categories[cat].append(('python', test))
-
-    print(f"\nFailure categories:")
-    for cat, tests in sorted(categories.items(), key=lambda x: -len(x[1])):
-        print(f"  {cat}: {len(tests)}")
-
     # Create todo directory
     todo_dir = Path('todo')
     todo_dir.mkdir(exist_ok=True)
 
-    # Generate documentation for each failed test
+    # Categorize each failed test as it is read and hand batches of docs
+    # to worker processes, so records can be dropped once written
     print(f"\nGenerating test documentation in {todo_dir}/...")
 
-    generated = 0
-    for test_type, tests in [('perl', perl_failed), ('python', python_failed)]:
-        for test in tests:
+    meta = {}
+    totals = {'perl': 0, 'python': 0}
+    failed = {'perl': 0, 'python': 0}
+    categories = defaultdict(list)
+    archive_path = todo_dir / 'reports.tar'
+    archive_mtime = int(time.time())
+
+    def flush(executor, archive, jobs):
+        if archive is None:
+            list(executor.map(write_test_doc, jobs.values(), chunksize=64))
+            return
+        for name, data in executor.map(render_test_doc, jobs.values(), chunksize=64):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = archive_mtime
+            archive.addfile(info, io.BytesIO(data))
+
+    # Keyed by doc path: tests whose names sanitize to the same file must not
+    # be written concurrently, and as before the last one wins. Batches run
+    # one after another, so this also holds across batches.
+    jobs = {}
+    with ProcessPoolExecutor() as executor, \
+            (open_archive(archive_path) if args.archive else nullcontext()) as archive:
+        for test_type, test in iter_test_results(json_path, meta):
+            totals[test_type] += 1
+            if test['passed']:
+                continue
+            failed[test_type] += 1
+
+            # Few distinct values across many records; share one copy of each
+            # while records wait in a batch (or stay loaded without ijson)
+            if test.get('failure_category'):
+                test['failure_category'] = sys.intern(test['failure_category'])
+
+            # Sanitize test name for filename; reused by the index below
             test_name = test['test_name']
-            safe_name = test_name.replace('--', '_').replace('.', '_')
+            safe_name = SAFE_NAME_RE.sub('_', test_name)
+
+            cat = categorize_failure(test)
+            categories[cat].append((test_type, test_name, safe_name))
 
             doc_path = todo_dir / f"{safe_name}.md"
-            doc_content = generate_test_doc(test, test_type)
+            jobs[str(doc_path)] = (test, test_type, cat, str(doc_path))
+            if len(jobs) >= WRITE_BATCH_SIZE:
+                flush(executor, archive, jobs)
+                jobs = {}
 
-            with open(doc_path, 'w') as f:
-                f.write(doc_content)
+        flush(executor, archive, jobs)
 
-            generated += 1
+    if args.archive:
+        print(f"Archived {sum(failed.values())} test documentation files in {archive_path}")
+    else:
+        print(f"Generated {sum(failed.values())} test documentation files")
+
+    # Statistics
+    print(f"\nPerl tests: {totals['perl']} total, {failed['perl']} failed")
+    print(f"Python tests: {totals['python']} total, {failed['python']} failed")
 
-    print(f"Generated {generated} test documentation files")
+    # Largest categories first, shared by the summary and the index
+    sorted_categories = sorted(categories.items(), key=lambda x: -len(x[1]))
+
+    print(f"\nFailure categories:")
+    for cat, tests in sorted_categories:
+        print(f"  {cat}: {len(tests)}")
 
     # Generate summary index
     index_path = todo_dir / 'README.md'
-    with open(index_path, 'w') as f:
-        f.write(f"""# Test Failure Analysis
+    parts = [f"""# Test Failure Analysis
 
 **Generated from**: {json_path.name}
-**Timestamp**: {data.get('timestamp', 'unknown')}
-**Total Failed**: {len(perl_failed) + len(python_failed)} / {len(perl_tests) + len(python_tests)}
+**Timestamp**: {meta.get('timestamp', 'unknown')}
+**Total Failed**: {sum(failed.values())} / {sum(totals.values())}
 
 ## Summary by Category
 
-""")
+"""]
+
+    for cat, tests in sorted_categories:
+        parts.append(f"\n### {cat} ({len(tests)} tests)\n\n")
+        for test_type, test_name, safe_name in tests:
+            parts.append(f"- [{test_name}](./{safe_name}.md) ({test_type})\n")
 
-        for cat, tests in sorted(categories.items(), key=lambda x: -len(x[1])):
-            f.write(f"\n### {cat} ({len(tests)} tests)\n\n")
-            for test_type, test in tests:
-                test_name = test['test_name']
-                safe_name = test_name.replace('--', '_').replace('.', '_')
-                f.write(f"- [{test_name}](./{safe_name}.md) ({test_type})\n")
+    index_path.write_text("".join(parts), encoding='utf-8')
 
     print(f"\nCreated index at {index_path}")
     print("\nDone!")